@@ -0,0 +1,132 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class SemanticCache:
+    """Reply cache keyed by (last user message, sentence type).
+
+    Literal repeats are answered from an exact‑match dict; anything else falls
+    back to cosine similarity against the stored (L2‑normalised) embeddings.
+    """
+
+    def __init__(self, path: Optional[str] = None, threshold: float = 0.9,
+                 capacity: int = 1024, log_callback=print):
+        self.path = path
+        self.log_callback = log_callback
+        self.threshold = threshold
+        # Rows [0, n) of E hold the cached embeddings, kept unit‑length so
+        # E @ q == cosine; the matrix is preallocated and doubled when full.
+        # Allocated on first insert, once the embedding width is known.
+        self.capacity = capacity
+        self.clear()
+        if path and os.path.exists(path):
+            self.load()
+
+    def clear(self) -> None:
+        self.n = 0
+        self.E: Optional[np.ndarray] = None
+        # Per‑row sentence type as a small int, so filtering is vectorised
+        self.type_codes = np.empty(self.capacity, dtype=np.int16)
+        self._codes: Dict[str, int] = {}
+        self.texts: List[str] = []
+        self.types: List[str] = []
+        self.replies: List[str] = []
+        self._exact: Dict[Tuple[str, str], str] = {}
+
+    def __len__(self) -> int:
+        return self.n
+
+    # --------------------------- Lookup ------------------------------ #
+
+    def get_exact(self, text: str, sentence_type: str) -> Optional[str]:
+        return self._exact.get((sentence_type, text))
+
+    def search(self, vec: np.ndarray, sentence_type: str) -> Optional[str]:
+        """Return the closest cached reply of the same type above threshold."""
+        q = _normalise(vec)
+        self._check_width(q.shape[0])
+        code = self._codes.get(sentence_type)
+        if self.n == 0 or code is None:
+            return None
+        sims = self.E[:self.n] @ q  # one BLAS gemv
+        sims[self.type_codes[:self.n] != code] = -1.0
+        i = int(sims.argmax())
+        if sims[i] < self.threshold:
+            return None
+        return self.replies[i]
+
+    # --------------------------- Insert ------------------------------ #
+
+    def add(self, text: str, sentence_type: str, vec: np.ndarray, reply: str) -> None:
+        row = _normalise(vec)
+        self._check_width(row.shape[0])
+        if self.E is None:
+            self.E = np.empty((self.capacity, row.shape[0]), dtype=np.float32)
+        elif self.n == self.capacity:
+            self._grow(2 * self.capacity)
+        self.E[self.n] = row
+        self.type_codes[self.n] = self._codes.setdefault(sentence_type, len(self._codes))
+        self.n += 1
+        self.texts.append(text)
+        self.types.append(sentence_type)
+        self.replies.append(reply)
+        self._exact[(sentence_type, text)] = reply
+
+    def _check_width(self, width: int) -> None:
+        """Drop stored rows made with a different embedding model."""
+        if self.E is not None and self.E.shape[1] != width:
+            self.log_callback(
+                f"[cache] dropping {self.n} entries with {self.E.shape[1]}-d "
+                f"embeddings (now {width}-d)"
+            )
+            self.clear()
+
+    def _grow(self, capacity: int) -> None:
+        E = np.empty((capacity, self.E.shape[1]), dtype=np.float32)
+        E[:self.n] = self.E[:self.n]
+        codes = np.empty(capacity, dtype=np.int16)
+        codes[:self.n] = self.type_codes[:self.n]
+        self.E, self.type_codes, self.capacity = E, codes, capacity
+
+    # ------------------------- Persistence --------------------------- #
+
+    def save(self) -> None:
+        if not self.path or self.n == 0:
+            return
+        # Write aside and swap in, so an interrupted save can't leave a
+        # truncated file behind
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                E=self.E[:self.n],
+                texts=np.array(self.texts),
+                types=np.array(self.types),
+                replies=np.array(self.replies),
+            )
+        os.replace(tmp_path, self.path)
+
+    def load(self) -> None:
+        """Replace the contents with the saved file; start empty if unreadable."""
+        try:
+            with np.load(self.path) as data:
+                E = data["E"].astype(np.float32)
+                texts = data["texts"].tolist()
+                types = data["types"].tolist()
+                replies = data["replies"].tolist()
+        except Exception as e:
+            self.log_callback(f"[cache load error] {self.path}: {e}")
+            self.clear()
+            return
+        self.capacity = max(self.capacity, len(E))
+        self.clear()
+        for vec, text, t, reply in zip(E, texts, types, replies):
+            self.add(text, t, vec, reply)
+
+
+def _normalise(vec: np.ndarray) -> np.ndarray:
+    vec = np.asarray(vec, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
@@ -1,15 +1,84 @@
 import asyncio
+import functools
+import importlib.util
 import os
 import sys
-from typing import List, Dict, Optional
+from collections import OrderedDict, deque
+from itertools import islice
+from typing import Deque, Dict, List, Optional, Tuple
 
+import httpx
+import numpy as np
+import tiktoken
 import websockets
 from dotenv import load_dotenv
-from openai import OpenAI  # openai >= 1.0.0
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient  # openai >= 1.0.0
+
+try:
+    import uvloop  # libuv event loop; not available on Windows
+except ImportError:
+    uvloop = None
+
+from cache import SemanticCache
 
 load_dotenv()
 openai_api_key = os.getenv("OPENAI_API_KEY")
-openai_client = OpenAI(api_key=openai_api_key)
+# One long‑lived connection pool shared by classify / reply / embedding
+# calls, so concurrent requests reuse warm TLS connections (multiplexed over
+# HTTP/2 when the optional ``h2`` package is installed).
+openai_http_client = DefaultAsyncHttpxClient(
+    http2=importlib.util.find_spec("h2") is not None,
+    limits=httpx.Limits(max_keepalive_connections=32, keepalive_expiry=300),
+)
+openai_client = AsyncOpenAI(api_key=openai_api_key, http_client=openai_http_client)
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Framing for streamed bot replies: every chunk is sent as STREAM_PARTIAL +
+# text, and a bare STREAM_END closes the reply.  Unframed messages are plain.
+STREAM_PARTIAL = "§"
+STREAM_END = "§§"
+
+# Several messages queued at once are sent as one frame joined by this
+# (ASCII record separator); recv_loop splits them apart again.
+RECORD_SEPARATOR = "\x1e"
+
+
+def label_token_ids(model: str, labels: Tuple[str, ...]) -> Optional[Dict[int, str]]:
+    """Map each label's token id to the label for *model*'s tokenizer.
+
+    Returns None when a label isn't exactly one token, in which case the
+    labels can't be forced via logit_bias.  Blocking: the first call for an
+    encoding may download it, and errors from that are propagated.
+    """
+    encoding = tiktoken.encoding_for_model(model)
+    ids: Dict[int, str] = {}
+    for label in labels:
+        tokens = encoding.encode(label)
+        if len(tokens) != 1:
+            return None
+        ids[tokens[0]] = label
+    return ids if len(ids) == len(labels) else None
+
+
+def run_event_loop(coro):
+    """Run *coro* to completion, on uvloop when it is installed."""
+    if uvloop is not None:
+        return uvloop.run(coro)
+    return asyncio.run(coro)
+
+
+async def open_connection(uri: str):
+    """Open a chat websocket to *uri*."""
+    # Keepalive pings, incoming backpressure and permessage‑deflate only
+    # add per‑frame work on our local chat socket of short text messages
+    return await websockets.connect(
+        uri,
+        max_queue=None,
+        ping_interval=None,
+        compression=None,
+        max_size=2**18,
+    )
 
 
 class ChatClient:
@@ -17,11 +86,22 @@ class ChatClient:
 
     def __init__(self, uri: str):
         self.uri = uri
+        # Loop the session runs on, for callers on other threads
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
 
     async def connect(self):
-        async with websockets.connect(self.uri) as ws:
+        self.loop = asyncio.get_running_loop()
+        if hasattr(asyncio, "eager_task_factory"):  # Python 3.12+
+            self.loop.set_task_factory(asyncio.eager_task_factory)
+        ws = await open_connection(self.uri)
+        try:
             await self.on_connect(ws)
-            await self.run_tasks(ws)
+            try:
+                await self.run_tasks(ws)
+            finally:
+                self.on_disconnect()
+        finally:
+            await ws.close()
 
     # ------------------------------------------------------------------ #
     # Lifecycle hooks – subclasses can override as needed                #
@@ -30,6 +110,10 @@ class ChatClient:
         """Called once when the websocket is ready."""
         pass
 
+    def on_disconnect(self):
+        """Called once when the session ends (also on Ctrl‑C)."""
+        pass
+
     async def run_tasks(self, ws):
         """Gather send / recv / extra tasks."""
         tasks = [self.send_loop(ws), self.recv_loop(ws), *self.extra_tasks(ws)]
@@ -39,8 +123,9 @@ class ChatClient:
         raise NotImplementedError
 
     async def recv_loop(self, ws):
-        async for message in ws:
-            await self.on_message(message, ws)
+        async for frame in ws:
+            for message in frame.split(RECORD_SEPARATOR):
+                await self.on_message(message, ws)
 
     async def on_message(self, message: str, ws):
         print(message)
@@ -50,29 +135,61 @@ class ChatClient:
 
     def run(self):
         try:
-            asyncio.run(self.connect())
+            run_event_loop(self.connect())
         except KeyboardInterrupt:
             print("Disconnected.")
 
 
 class GUIUserClient(ChatClient):
-    """User client that integrates with a GUI entry widget."""
+    """User client that integrates with a GUI entry widget.
 
-    def __init__(self, uri: str, display_callback):
+    ``stream_callback(text, done)`` receives streamed replies piece by piece;
+    without it they are buffered and shown through ``display_callback``.
+    """
+
+    def __init__(self, uri: str, display_callback, stream_callback=None):
         super().__init__(uri)
         self.display_callback = display_callback
+        self.stream_callback = stream_callback
         self.send_queue: asyncio.Queue[str] = asyncio.Queue()
+        # Chunks of the reply currently being streamed (None when idle)
+        self._stream: Optional[List[str]] = None
 
     def send_message(self, msg: str) -> None:
-        self.send_queue.put_nowait(msg)
+        """Queue *msg* for sending; safe to call from the GUI thread."""
+        if self.loop is None:  # not connected yet – nothing awaits the queue
+            self.send_queue.put_nowait(msg)
+        else:
+            # asyncio.Queue isn't thread‑safe, and the loop must be woken up
+            self.loop.call_soon_threadsafe(self.send_queue.put_nowait, msg)
 
     async def send_loop(self, ws):
         while True:
             msg = await self.send_queue.get()
+            # Merge whatever else is already queued into the same frame
+            while not self.send_queue.empty():
+                msg += RECORD_SEPARATOR + self.send_queue.get_nowait()
             await ws.send(msg)
 
     async def on_message(self, message: str, ws):
-        self.display_callback(f"Friend: {message}")
+        if message == STREAM_END:
+            self._on_stream_chunk("", done=True)
+        elif message.startswith(STREAM_PARTIAL):
+            self._on_stream_chunk(message[len(STREAM_PARTIAL):], done=False)
+        else:
+            self.display_callback(f"Friend: {message}")
+
+    def _on_stream_chunk(self, text: str, done: bool) -> None:
+        if self._stream is None:
+            self._stream = []
+            text = "Friend: " + text
+        self._stream.append(text)
+        if self.stream_callback is not None:
+            self.stream_callback(text, done)
+        elif done:
+            self.display_callback("".join(self._stream))
+        if done:
+            self._stream = None
 
 
 # ---------------------------------------------------------------------- #
@@ -95,19 +212,75 @@ class GPTClient(ChatClient):
         "bye": "대화 종료"            # polite closing
     }
 
-    def __init__(self, uri: str, model: str = "gpt-3.5-turbo"):
+    #: Classifier prompt – the key is forced by logit_bias, so it stays short
+    CLASSIFY_SYSTEM_PROMPT = {
+        "role": "system",
+        "content": (
+            "사용자의 마지막 메시지 다음에 올 답변 유형의 key 하나만 출력해라.\n"
+            "ack=간결한 호응, op=의견·제안, new=새 주제, bye=대화 종료"
+        ),
+    }
+
+    #: Remembered classifications (by exact user message)
+    INTENT_CACHE_SIZE = 1024
+
+    #: Identity prompt – kept byte‑identical across calls so OpenAI's
+    #: automatic prompt caching can reuse the prefix.
+    REPLY_SYSTEM_PROMPT = {
+        "role": "system",
+        "content": (
+            "너는 20대 남성 대학생 친구로, 인터넷 커뮤니티 단답 같은 가벼운 말투를 사용한다. "
+            "마지막 '유형:' 메시지는 상대가 원하는 답변 유형이다. "
+            "그 유형에 맞는 한두 문장만 출력해라."
+        ),
+    }
+
+    #: Per‑type trailing hint appended after the history
+    TYPE_HINTS = {
+        key: {"role": "system", "content": f"유형: {desc}"}
+        for key, desc in SENTENCE_TYPES.items()
+    }
+
+    def __init__(self, uri: str, model: str = "gpt-3.5-turbo",
+                 cache_path: Optional[str] = "semantic_cache.npz", max_merge: int = 8,
+                 log_callback=None):
         super().__init__(uri)
         self.model = model
-        # Full conversation history (OpenAI format)
-        self.message_history: List[Dict[str, str]] = [
-            {"role": "system", "content": "컴퓨터공학과 대학생 친구이다. 인터넷 커뮤니티 댓글같은 단답 위주의 20대 남성의 말투 소유."}
-        ]
-        # Whether we have a pending reply to send
-        self.pending_sentence_type: Optional[str] = None
+        # Where bot activity is reported (stdout unless the host app wants it)
+        self.log_callback = log_callback or functools.partial(print, flush=True)
+        # Classifier label token ids (None: not loaded yet, or not forceable)
+        self._label_tokens: Optional[Dict[int, str]] = None
+        self._label_tokens_loaded = False
+        self._label_tokens_task: Optional[asyncio.Task] = None
+        # user message -> sentence type, least recently used first
+        self._intent_cache: "OrderedDict[str, str]" = OrderedDict()
+        # At most this many back‑to‑back user messages are merged into one turn
+        self.max_merge = max_merge
+        # Messages merged into the user turn we haven't answered yet (0 = none)
+        self._merged = 0
+        # Replies reused for near‑identical (user message, sentence type) pairs
+        self.cache = SemanticCache(cache_path, log_callback=self.log_callback)
+        # Recent conversation turns (OpenAI format), oldest dropped first
+        self.message_history: Deque[Dict[str, str]] = deque(maxlen=64)
+        # Sentence types whose replies are drafted while classification runs;
+        # the other types are generated once classification picks them
+        self.speculative_types: Tuple[str, ...] = ("ack", "op")
+        # In‑flight work for the latest user message (None once we talked):
+        # the (turn text, recent context) snapshot every draft works from
+        self._turn: Optional[Tuple[str, List[Dict[str, str]]]] = None
+        self._classify_task: Optional[asyncio.Task] = None
+        # sentence type -> (draft task, queue of streamed chunks)
+        self._drafts: Dict[str, Tuple[asyncio.Task, asyncio.Queue]] = {}
+        # (text, task) of the latest embedding, shared by speculative replies
+        self._embedding: Optional[Tuple[str, asyncio.Task]] = None
+        # Seconds of user silence before we classify and draft (debounce)
+        self.idle_seconds_before_draft = 0.5
         # Seconds to wait before speaking if user hasn’t typed further
         self.idle_seconds_before_talk = 2.0
         # Timestamp (monotonic) of last user message we saw
         self._last_user_ts: float = 0.0
+        # Set when a user turn is waiting for a reply; wakes talk_loop
+        self._pending_event = asyncio.Event()
 
     # ------------------------ Life‑cycle hooks ------------------------ #
 
@@ -117,100 +290,257 @@ class GPTClient(ChatClient):
 
     async def on_message(self, message: str, ws):
         """Called whenever a user message arrives on the socket."""
-        # 1) Append to history
-        self.message_history.append({"role": "user", "content": message})
+        # 1) Append to history – a burst of messages before we talk becomes
+        #    one user turn, sent to the model as a single message
+        if 0 < self._merged < self.max_merge:
+            message = self.message_history[-1]["content"] + "\n" + message
+            self.message_history[-1] = {"role": "user", "content": message}
+            self._merged += 1
+        else:
+            self.message_history.append({"role": "user", "content": message})
+            self._merged = 1
         self._last_user_ts = asyncio.get_running_loop().time()
-        # 2) Classify what kind of answer the user probably wants
-        loop = asyncio.get_running_loop()
-        sentence_type: str = await loop.run_in_executor(None, self._classify_intent, message)
-        # 3) Store – talk_loop will pick this up and send when appropriate
-        self.pending_sentence_type = sentence_type
+        # 2) Drafts for the turn so far are stale now
+        self._cancel_speculation()
+        # 3) Wake talk_loop – it starts classifying and drafting once the
+        #    user pauses, so a fast burst doesn't restart the work per message
+        self._pending_event.set()
+
+    async def on_connect(self, ws):
+        # Open the OpenAI connection now so the first user message doesn't
+        # pay for the TCP/TLS handshake
+        await self._embed("warm-up")
+        # Load the tokenizer before anyone is waiting on a classification
+        await self._load_label_tokens()
+
+    def on_disconnect(self):
+        self.cache.save()
 
     def extra_tasks(self, ws):
         return [self._talk_loop(ws)]
 
+    def _cancel_speculation(self) -> None:
+        if self._classify_task is not None:
+            self._classify_task.cancel()
+        for task, _ in self._drafts.values():
+            task.cancel()
+        self._turn = None
+        self._classify_task = None
+        self._drafts = {}
+
+    async def _load_label_tokens(self) -> None:
+        """Look up the label token ids in a worker thread (may download)."""
+        try:
+            self._label_tokens = await asyncio.to_thread(
+                label_token_ids, self.model, tuple(self.SENTENCE_TYPES)
+            )
+        except Exception as e:
+            # Not remembered – the next classification retries the load
+            self.log_callback(f"[tokenizer error] {e}")
+            return
+        self._label_tokens_loaded = True
+        if self._label_tokens is None:
+            self.log_callback("[tokenizer] labels aren't single tokens; classifying without logit_bias")
+
+    def _ensure_label_tokens(self) -> None:
+        """Retry a failed tokenizer load in the background."""
+        if self._label_tokens_loaded:
+            return
+        if self._label_tokens_task is None or self._label_tokens_task.done():
+            self._label_tokens_task = asyncio.create_task(self._load_label_tokens())
+
+    def _start_speculation(self) -> None:
+        # Snapshot the turn once: messages arriving later must not leak into
+        # drafts (or cache keys) for this turn
+        history = self.message_history
+        context = list(islice(history, max(0, len(history) - 5), None))
+        self._turn = (self._last_user_message(), context)
+        self._classify_task = asyncio.create_task(self._classify_intent(self._turn[0]))
+        self._drafts = {
+            key: self._start_draft(key, self._turn) for key in self.speculative_types
+        }
+
+    def _start_draft(self, sentence_type: str,
+                     turn: Tuple[str, List[Dict[str, str]]]) -> Tuple[asyncio.Task, asyncio.Queue]:
+        chunks: asyncio.Queue = asyncio.Queue()
+        task = asyncio.create_task(self._generate_reply(sentence_type, turn, chunks))
+        return task, chunks
+
     # --------------------- Core asynchronous loops ------------------- #
 
     async def _talk_loop(self, ws):
-        """Every few hundred ms decide whether to speak and, if so, reply."""
+        """Sleep until a user turn is pending and idle long enough, then reply."""
         loop = asyncio.get_running_loop()
         while True:
-            await asyncio.sleep(0.3)
             # Preconditions: is there something to say?
-            if self.pending_sentence_type is None:
-                continue  # nothing queued
-            # Check if we already replied after the *last* user message
-            if self.message_history and self.message_history[-1]["role"] == "assistant":
-                # We already talked, clear the pending flag
-                self.pending_sentence_type = None
-                continue
-            # Has the user been idle long enough?
+            await self._pending_event.wait()
+            # Has the user paused?  Then classify and draft replies in
+            # parallel, so they are ready (or streaming) by the time we talk.
+            # After every sleep we check again in case they kept typing.
             since_last_user = loop.time() - self._last_user_ts
+            if since_last_user < self.idle_seconds_before_draft:
+                await asyncio.sleep(self.idle_seconds_before_draft - since_last_user)
+                continue
+            if self._classify_task is None:
+                self._start_speculation()
+            # Has the user been idle long enough to talk?
             if since_last_user < self.idle_seconds_before_talk:
-                continue  # give user more time to keep typing
-            # ---- Issue talk: generate reply and send ----
-            sentence_type = self.pending_sentence_type
-            self.pending_sentence_type = None  # reset before generation
-            reply = await loop.run_in_executor(None, self._generate_reply, sentence_type)
-            await ws.send(reply)
-            self.message_history.append({"role": "assistant", "content": reply})
-            # Optional: log to stdout so log window can show it
-            print(f"[GPT → user ({sentence_type})] {reply}", flush=True)
+                await asyncio.sleep(self.idle_seconds_before_talk - since_last_user)
+                continue
+            # ---- Issue talk: take the in‑flight work for this turn ----
+            self._pending_event.clear()
+            turn, classify_task, drafts = self._turn, self._classify_task, self._drafts
+            self._turn, self._classify_task, self._drafts = None, None, {}
+            self._merged = 0  # later messages start a new turn
+            # Reserve the reply's slot right after the turn it answers, so
+            # messages typed while we stream are recorded after it
+            answer = {"role": "assistant", "content": ""}
+            self.message_history.append(answer)
+            sentence_type = await classify_task
+            draft = drafts.pop(sentence_type, None)
+            for task, _ in drafts.values():
+                task.cancel()  # drafts for the other types lost
+            if draft is None:
+                draft = self._start_draft(sentence_type, turn)
+            # Forward what the draft has buffered so far, then stream the rest
+            reply_task, chunks = draft
+            while (chunk := await chunks.get()) is not None:
+                await ws.send(STREAM_PARTIAL + chunk)
+            await ws.send(STREAM_END)
+            reply, fresh = await reply_task
+            answer["content"] = reply
+            if fresh:  # only the reply we actually sent is worth reusing
+                await self._remember(turn[0], sentence_type, reply)
+            # Report to the log (the GUI shows it in the log window)
+            self.log_callback(f"[GPT → user ({sentence_type})] {reply}")
 
     # --------------------- OpenAI helper functions ------------------- #
 
-    def _classify_intent(self, last_user_msg: str) -> str:
+    async def _classify_intent(self, last_user_msg: str) -> str:
         """Return one of "ack" | "op" | "new" | "bye"."""
-        system_prompt = (
-            "너는 대화 분석기다. 사용자의 마지막 메시지를 보고, "
-            "상대가 다음 단계에서 원하는 답변 유형을 아래 네 가지 중 하나의 "
-            "key 로만 출력해라 (텍스트 말고 JSON 도 말고, key 단독).\n"
-            "ack  – 간결한 호응 (맞장구, 네 등)\n"
-            "op   – 의견 또는 제안\n"
-            "new  – 새로운 주제 시작\n"
-            "bye  – 대화 종료\n"
-            "주의: 딱 한 단어(key)만 출력해야 한다."
-        )
+        if last_user_msg in self._intent_cache:
+            self._intent_cache.move_to_end(last_user_msg)
+            return self._intent_cache[last_user_msg]
+        # Restrict the single output token to the four keys when we can
+        self._ensure_label_tokens()
+        token_ids = self._label_tokens
+        logit_bias = {tid: 100 for tid in token_ids} if token_ids else None
         try:
-            completion = openai_client.chat.completions.create(
+            completion = await openai_client.chat.completions.create(
                 model=self.model,
                 messages=[
-                    {"role": "system", "content": system_prompt},
+                    self.CLASSIFY_SYSTEM_PROMPT,
                     {"role": "user", "content": last_user_msg},
                 ],
                 temperature=0.0,  # deterministic classification
                 max_tokens=1,
+                logit_bias=logit_bias,
             )
             key = completion.choices[0].message.content.strip().lower()
         except Exception as e:
-            print(f"[classify error] {e}")
-            key = "ack"
+            self.log_callback(f"[classify error] {e}")
+            return "ack"
         if key not in self.SENTENCE_TYPES:
-            key = "ack"
+            return "ack"
+        self._intent_cache[last_user_msg] = key
+        if len(self._intent_cache) > self.INTENT_CACHE_SIZE:
+            self._intent_cache.popitem(last=False)
         return key
 
-    def _generate_reply(self, sentence_type: str) -> str:
-        """Generate the actual assistant sentence based on the required type."""
-        type_desc = self.SENTENCE_TYPES.get(sentence_type, "간결한 호응")
-        sys_msg = (
-            "너는 20대 남성 대학생 친구로, 인터넷 커뮤니티 단답 같은 가벼운 말투를 사용한다. "
-            "지금은 상대가 원하는 답변 유형이 '" + type_desc + "' 라는 정보를 알고 있다. "
-            "그 유형에 맞는 한두 문장만 출력해라."
-        )
+    async def _embedding_for(self, text: str) -> Optional[np.ndarray]:
+        """Embed *text* once, however many speculative replies ask for it."""
+        if self._embedding is None or self._embedding[0] != text:
+            self._embedding = (text, asyncio.ensure_future(self._embed(text)))
+        # Shielded so cancelling one draft doesn't cancel the shared call
+        return await asyncio.shield(self._embedding[1])
+
+    async def _embed(self, text: str) -> Optional[np.ndarray]:
+        """Return the embedding of *text*, or None if the API call fails."""
+        try:
+            response = await openai_client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        except Exception as e:
+            self.log_callback(f"[embed error] {e}")
+            return None
+        return np.asarray(response.data[0].embedding, dtype=np.float32)
+
+    def _last_user_message(self) -> str:
+        for msg in reversed(self.message_history):
+            if msg["role"] == "user":
+                return msg["content"]
+        return ""
+
+    async def _generate_reply(self, sentence_type: str,
+                              turn: Tuple[str, List[Dict[str, str]]],
+                              chunks: asyncio.Queue) -> Tuple[str, bool]:
+        """Generate the actual assistant sentence based on the required type.
+
+        *turn* is the (user text, recent context) snapshot being answered.
+        Text is put on *chunks* as it arrives, followed by ``None`` once the
+        reply is complete.  Returns the full reply and whether it is a fresh
+        completion (as opposed to a cache hit or an error message).
+        """
+        try:
+            turn_text, context = turn
+            reply = await self._cached_reply(turn_text, sentence_type)
+            if reply is not None:
+                chunks.put_nowait(reply)
+                return reply, False
+            return await self._stream_reply(sentence_type, context, chunks)
+        finally:
+            chunks.put_nowait(None)
+
+    async def _cached_reply(self, last_user_msg: str, sentence_type: str) -> Optional[str]:
+        """Serve repeats from the cache before paying for a completion."""
+        try:
+            cached = self.cache.get_exact(last_user_msg, sentence_type)
+            if cached is None:
+                vec = await self._embedding_for(last_user_msg)
+                if vec is not None:
+                    cached = self.cache.search(vec, sentence_type)
+        except Exception as e:
+            # A broken cache is only a miss – never cost us the reply
+            self.log_callback(f"[cache error] {e}")
+            return None
+        return cached
+
+    async def _remember(self, text: str, sentence_type: str, reply: str) -> None:
+        vec = await self._embedding_for(text)
+        if vec is None:
+            return
+        try:
+            self.cache.add(text, sentence_type, vec, reply)
+        except Exception as e:
+            self.log_callback(f"[cache error] {e}")
+
+    async def _stream_reply(self, sentence_type: str, context: List[Dict[str, str]],
+                            chunks: asyncio.Queue) -> Tuple[str, bool]:
+        type_hint = self.TYPE_HINTS.get(sentence_type, self.TYPE_HINTS["ack"])
+        parts: List[str] = []
         try:
-            completion = openai_client.chat.completions.create(
+            stream = await openai_client.chat.completions.create(
                 model=self.model,
                 messages=[
-                    {"role": "system", "content": sys_msg},
-                    *self.message_history[-5:],  # recent context only
+                    self.REPLY_SYSTEM_PROMPT,
+                    *context,
+                    type_hint,
                 ],
                 temperature=0.7,
                 max_tokens=80,
+                stream=True,
             )
-            reply = completion.choices[0].message.content.strip()
+            # Closing on exit returns the connection to the pool even when a
+            # losing or stale draft is cancelled mid‑stream
+            async with stream:
+                async for event in stream:
+                    text = event.choices[0].delta.content if event.choices else None
+                    if text:
+                        parts.append(text)
+                        chunks.put_nowait(text)
         except Exception as e:
-            reply = f"[GPT error] {e}"
-        return reply
+            error = f"[GPT error] {e}"
+            chunks.put_nowait(error)
+            return "".join(parts) + error, False
+        return "".join(parts).strip(), True
 
 
 # ---------------------------------------------------------------------- #
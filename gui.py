@@ -11,6 +11,8 @@ class ChatWindow:
         self.entry.pack(padx=5, pady=5)
         self.entry.bind("<Return>", self.on_send)
         self.send_callback = send_callback
+        # Whether a streamed message's line is still open (see append_stream)
+        self._streaming = False
 
     def on_send(self, event=None):
         msg = self.entry.get().strip()
@@ -26,6 +28,28 @@ class ChatWindow:
             self.text.configure(state="disabled")
             self.text.see(tk.END)
         self.text.after(0, _append)
+
+    def append_stream(self, text: str, done: bool):
+        """Append a piece of a streamed message; *done* ends the line.
+
+        Pieces go in at the "stream" mark, so messages appended while the
+        line is still open land below it rather than inside it.
+        """
+        def _append():
+            self.text.configure(state="normal")
+            if not self._streaming:
+                # Open the line with its newline already in place and park
+                # the (right‑gravity) mark just before that newline
+                self.text.insert(tk.END, "\n")
+                self.text.mark_set("stream", "end-2c")
+                self._streaming = True
+            self.text.insert("stream", text)
+            if done:
+                self.text.mark_unset("stream")
+                self._streaming = False
+            self.text.configure(state="disabled")
+            self.text.see(tk.END)
+        self.text.after(0, _append)
         
     def mainloop(self):
         """Run the Tkinter main loop."""
@@ -1,65 +1,74 @@
-import subprocess
-import sys
-import time
-import os
+import asyncio
 import threading
 import queue
-from client import GUIUserClient
+from tkinter import TclError
+from client import GPTClient, GUIUserClient, run_event_loop
 from gui import ChatWindow, LogWindow
+from server import ChatServer
 
-SERVER_SCRIPT = "server.py"
-CLIENT_SCRIPT = "client.py"
+URI = "ws://localhost:8765"
 
 
 def main():
-    # 1. Launch server (capture output to keep console clean)
-    server_proc = subprocess.Popen([
-        sys.executable,
-        SERVER_SCRIPT,
-    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    time.sleep(1)  # give server time to bind
-
-    # 2. Launch GPT bot and capture logs
-    gpt_proc = subprocess.Popen(
-        [sys.executable, "-u", CLIENT_SCRIPT, "gpt"],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-        bufsize=1,
-    )
-
     chat_window = ChatWindow(lambda msg: None)
     log_window = LogWindow(chat_window.root)
     log_queue: queue.Queue[str] = queue.Queue()
 
-    def log_reader():
-        for line in gpt_proc.stdout:
-            log_queue.put(line.rstrip())
-
-    threading.Thread(target=log_reader, daemon=True).start()
-    
-    chat_client = GUIUserClient("ws://localhost:8765", chat_window.append_message)
+    chat_client = GUIUserClient(URI, chat_window.append_message, chat_window.append_stream)
     chat_window.send_callback = chat_client.send_message
 
-    def client_thread():
-        chat_client.run()
+    log_wakeup_pending = threading.Event()
 
-    threading.Thread(target=client_thread, daemon=True).start()
+    def push_log(line: str) -> None:
+        # Called from the backend thread: queue the line, then wake Tk –
+        # once per batch, since every event_generate waits on the Tk thread
+        log_queue.put(line)
+        if log_wakeup_pending.is_set():
+            return
+        log_wakeup_pending.set()
+        try:
+            chat_window.root.event_generate("<<Log>>", when="tail")
+        except (RuntimeError, TclError):
+            # Tk not running (startup / window closed) – never kill the bot;
+            # lines queued before mainloop are drained once it starts
+            log_wakeup_pending.clear()
 
-    def poll_logs():
+    def drain_logs(event=None):
+        log_wakeup_pending.clear()
         while not log_queue.empty():
             log_window.append_log(log_queue.get())
-        chat_window.root.after(100, poll_logs)
 
-    poll_logs()
+    chat_window.root.bind("<<Log>>", drain_logs)
+    chat_window.root.after(0, drain_logs)
+    gpt_client = GPTClient(URI, log_callback=push_log)
+
+    backend_ready = threading.Event()
+    backend_handles = {}
+
+    async def backend():
+        # Server, GPT bot and GUI client share one event loop in this process
+        backend_handles["loop"] = asyncio.get_running_loop()
+        backend_handles["task"] = asyncio.current_task()
+        backend_ready.set()
+        server = ChatServer()
+        await server.listen()  # bound before anyone connects, no sleep needed
+        await asyncio.gather(gpt_client.connect(), chat_client.connect())
+
+    def backend_thread():
+        try:
+            run_event_loop(backend())
+        except asyncio.CancelledError:
+            pass  # window closed
+
+    thread = threading.Thread(target=backend_thread, daemon=True)
+    thread.start()
+
+    chat_window.mainloop()
 
-    try:
-        chat_window.mainloop()
-    finally:
-        server_proc.terminate()
-        gpt_proc.terminate()
-        server_proc.wait()
-        gpt_proc.wait()
+    # Cancel the backend so the clients unwind (GPTClient saves its cache)
+    if backend_ready.wait(timeout=1):
+        backend_handles["loop"].call_soon_threadsafe(backend_handles["task"].cancel)
+    thread.join(timeout=5)
 
 if __name__ == "__main__":
     main()
@@ -1,40 +1,85 @@
 import asyncio
 import websockets
 
+try:
+    import uvloop  # libuv event loop; not available on Windows
+except ImportError:
+    uvloop = None
+
 class ChatServer:
     def __init__(self, host='localhost', port=8765):
         self.host = host
         self.port = port
-        self.users = set()
+        self.send_queue_size = 128
+        # websocket -> (outgoing queue, relay task draining it)
+        self.users = {}
+        # close() calls for clients we cut loose, kept alive until done
+        self._closing = set()
 
     async def register(self, websocket):
-        self.users.add(websocket)
+        queue = asyncio.Queue(maxsize=self.send_queue_size)
+        relay = asyncio.create_task(self._relay(websocket, queue))
+        self.users[websocket] = (queue, relay)
 
     async def unregister(self, websocket):
-        self.users.remove(websocket)
+        entry = self.users.pop(websocket, None)
+        if entry is not None:
+            entry[1].cancel()
+
+    async def _relay(self, websocket, queue):
+        """Deliver queued messages to one user, at that user's own pace."""
+        while True:
+            message = await queue.get()
+            try:
+                await websocket.send(message)
+            except websockets.ConnectionClosed:
+                return
 
     async def handler(self, websocket):
         await self.register(websocket)
         try:
             async for message in websocket:
                 await self.broadcast(message, sender=websocket)
+        except websockets.ConnectionClosed:
+            pass  # includes clients we disconnected for falling behind
         finally:
             await self.unregister(websocket)
 
     async def broadcast(self, message, sender=None):
-        for user in self.users:
-            if user != sender:
-                await user.send(message)
+        # Only enqueue – each user's relay task does the actual send, so a
+        # slow client never stalls the sender or the other recipients
+        stalled = []
+        for user, (queue, _) in self.users.items():
+            if user == sender:
+                continue
+            if queue.full():
+                stalled.append(user)
+            else:
+                queue.put_nowait(message)
+        # Dropping single frames would corrupt streamed replies, so a client
+        # that fell a whole queue behind is disconnected instead
+        for user in stalled:
+            await self.unregister(user)
+            closing = asyncio.create_task(user.close(1013, "send queue overflow"))
+            self._closing.add(closing)
+            closing.add_done_callback(self._closing.discard)
 
-    async def start(self):
-        await websockets.serve(self.handler, self.host, self.port)
+    async def listen(self):
+        """Start accepting connections; returns once the port is bound."""
+        await websockets.serve(self.handler, self.host, self.port, compression=None)
         print(f"Chat server started at ws://{self.host}:{self.port}")
+
+    async def start(self):
+        await self.listen()
         await asyncio.Future()
 
 if __name__ == '__main__':
     server = ChatServer()
     try:
-        asyncio.run(server.start())
+        if uvloop is not None:
+            uvloop.run(server.start())
+        else:
+            asyncio.run(server.start())
     except KeyboardInterrupt:
         print("Server stopped.")
 